@@ -3,10 +3,20 @@ CrewAI nabl Integration
 FastAPI server that exposes CrewAI agents with nabl workflow tools
 """
 
+import asyncio
 import os
+import ssl
+import threading
+import time
 import httpx
-from fastapi import FastAPI
-from pydantic import BaseModel
+import msgspec
+import orjson
+from cachetools import TTLCache
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from urllib.parse import urlsplit, urlunsplit
 from crewai import Agent, Task, Crew, Process
 from crewai_tools import BaseTool
 
@@ -14,7 +24,114 @@ from crewai_tools import BaseTool
 ICLAW_API_URL = os.getenv("ICLAW_API_URL", "https://api.iclaw.dev")
 ICLAW_API_KEY = os.getenv("ICLAW_API_KEY")
 
-app = FastAPI(title="iClaw CrewAI Agent")
+JSON_HEADERS = {"content-type": "application/json"}
+
+WORKFLOW_CONNECT_RETRIES = 2
+WORKFLOW_RETRY_BACKOFF = 0.5
+
+# Shared by every tool call so keep-alive connections are reused
+_HTTP = httpx.Client(
+    # Read must outlast discovery's silent Apify poll (up to 120s upstream);
+    # a client-side timeout still gets the run charged
+    timeout=httpx.Timeout(connect=5.0, read=150.0, write=10.0, pool=5.0),
+    # Pool settings live on the transport. Its own retries stay off: httpcore
+    # would also retry TLS/certificate failures, see _post_workflow
+    transport=httpx.HTTPTransport(
+        limits=httpx.Limits(
+            max_connections=200,
+            max_keepalive_connections=50,
+            keepalive_expiry=30.0
+        ),
+        http2=True,
+        retries=0
+    )
+)
+
+
+# Crew runs are blocking, so they execute here instead of on the event loop
+_KICKOFF_EXECUTOR = ThreadPoolExecutor(max_workers=32, thread_name_prefix="crew")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Open a keep-alive connection up front so the first tool call skips the
+    # DNS lookup and TLS handshake
+    try:
+        await asyncio.to_thread(_HTTP.get, f"{ICLAW_API_URL}/health", timeout=5.0)
+    except Exception:
+        pass
+    yield
+    _KICKOFF_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+    _HTTP.close()
+
+
+app = FastAPI(
+    title="iClaw CrewAI Agent",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
+)
+
+# Workflow result cache, keyed on workflow name + canonicalized params
+_RESULT_CACHE: TTLCache = TTLCache(maxsize=4096, ttl=3600)
+_RESULT_CACHE_LOCK = threading.Lock()
+
+
+def _cache_get(key: tuple) -> dict | None:
+    with _RESULT_CACHE_LOCK:
+        return _RESULT_CACHE.get(key)
+
+
+def _cache_put(key: tuple, result: dict) -> None:
+    # Only successes: 'pending' and 'insufficient_balance' must not outlive
+    # the job finishing or the wallet being topped up
+    if result.get("status") != "success":
+        return
+    with _RESULT_CACHE_LOCK:
+        _RESULT_CACHE[key] = result
+
+
+def _canonical_url(url: str) -> str:
+    """Lowercase only the scheme and host; paths and queries are case-sensitive."""
+    url = url.strip()
+    if "://" not in url and not url.startswith("//"):
+        url = "//" + url
+    parts = urlsplit(url)
+    return urlunsplit(parts._replace(scheme=parts.scheme.lower(), netloc=parts.netloc.lower()))
+
+
+def _is_ssl_error(exc: BaseException) -> bool:
+    # httpx wraps handshake and certificate failures in ConnectError; the
+    # ssl.SSLError is further down the exception chain
+    while exc is not None:
+        if isinstance(exc, ssl.SSLError):
+            return True
+        exc = exc.__cause__ or exc.__context__
+    return False
+
+
+def _post_workflow(workflow: str, params: dict) -> dict:
+    """POST a workflow run, retrying only when the connection could not be made.
+    
+    SSL and certificate failures are not transient, so they are raised
+    immediately; other connect errors back off exponentially between tries.
+    """
+    payload = orjson.dumps({
+        "workflow": workflow,
+        "params": params,
+        "iclaw_key": ICLAW_API_KEY
+    })
+    for attempt in range(WORKFLOW_CONNECT_RETRIES + 1):
+        try:
+            response = _HTTP.post(
+                f"{ICLAW_API_URL}/api/v1/workflow",
+                content=payload,
+                headers=JSON_HEADERS
+            )
+            return orjson.loads(response.content)
+        except httpx.ConnectError as e:
+            if _is_ssl_error(e) or attempt == WORKFLOW_CONNECT_RETRIES:
+                raise
+            time.sleep(WORKFLOW_RETRY_BACKOFF * 2 ** attempt)
 
 
 # Custom Tools
@@ -25,24 +142,17 @@ class NablAuditTool(BaseTool):
     
     def _run(self, url: str) -> str:
         """Execute the audit synchronously."""
-        import httpx
-        with httpx.Client() as client:
-            response = client.post(
-                f"{ICLAW_API_URL}/api/v1/workflow",
-                json={
-                    "workflow": "audit",
-                    "params": {"url": url},
-                    "iclaw_key": ICLAW_API_KEY
-                },
-                timeout=120.0
-            )
-            result = response.json()
-            
-            if result.get("status") == "error":
-                return f"Audit failed: {result.get('error')}"
-            
-            data = result.get("result", {})
-            return f"""
+        key = ("audit", _canonical_url(url))
+        result = _cache_get(key)
+        if result is None:
+            result = _post_workflow("audit", {"url": url})
+            _cache_put(key, result)
+        
+        if result.get("status") != "success":
+            return f"Audit failed: {result.get('error') or result.get('status')}"
+        
+        data = result.get("result", {})
+        return f"""
 Audit Results for {data.get('url')}:
 - Overall Score: {data.get('score')}/100
 - Critical Issues: {data.get('critical_issues')}
@@ -58,67 +168,80 @@ class NablDiscoveryTool(BaseTool):
     
     def _run(self, query: str) -> str:
         """Execute discovery synchronously."""
-        parts = query.split("|")
-        if len(parts) != 2:
+        niche, _, location = query.partition("|")
+        niche, location = niche.strip(), location.strip()
+        if not niche or not location:
             return "Invalid format. Use: 'niche|location'"
         
-        niche, location = parts[0].strip(), parts[1].strip()
+        key = ("discovery", niche.lower(), location.lower(), 10)
+        result = _cache_get(key)
+        if result is None:
+            result = _post_workflow("discovery", {"niche": niche, "location": location, "limit": 10})
+            _cache_put(key, result)
         
-        import httpx
-        with httpx.Client() as client:
-            response = client.post(
-                f"{ICLAW_API_URL}/api/v1/workflow",
-                json={
-                    "workflow": "discovery",
-                    "params": {"niche": niche, "location": location, "limit": 10},
-                    "iclaw_key": ICLAW_API_KEY
-                },
-                timeout=120.0
-            )
-            result = response.json()
-            
-            if result.get("status") == "error":
-                return f"Discovery failed: {result.get('error')}"
-            
-            data = result.get("result", {})
-            businesses = data.get("businesses", [])
-            
-            output = f"Found {data.get('total_found')} {niche} businesses in {location}:\n\n"
-            for i, biz in enumerate(businesses[:5], 1):
-                output += f"{i}. {biz.get('name')}\n"
-                if biz.get('phone'): output += f"   Phone: {biz.get('phone')}\n"
-                if biz.get('website'): output += f"   Website: {biz.get('website')}\n"
-            
-            return output
+        if result.get("status") != "success":
+            return f"Discovery failed: {result.get('error') or result.get('status')}"
+        
+        data = result.get("result", {})
+        businesses = data.get("businesses", [])
+        
+        parts = [f"Found {data.get('total_found')} {niche} businesses in {location}:", ""]
+        for i, biz in enumerate(businesses[:5], 1):
+            parts.append(f"{i}. {biz.get('name')}")
+            if biz.get('phone'): parts.append(f"   Phone: {biz.get('phone')}")
+            if biz.get('website'): parts.append(f"   Website: {biz.get('website')}")
+        
+        return "\n".join(parts)
 
 
 # Create agents
-def create_research_agent():
+# Tools are stateless and shared. Agents are not: Crew.kickoff() rebinds the
+# agent's crew, executor and task, so each request builds its own.
+_AUDIT_TOOL = NablAuditTool()
+_DISCOVERY_TOOL = NablDiscoveryTool()
+
+
+def create_research_agent(step_callback=None):
     return Agent(
         role="Research Assistant",
         goal="Help users find information about businesses and websites",
         backstory="""You are an expert at researching businesses and analyzing websites.
         You use specialized tools to gather accurate, real-time information.""",
-        tools=[NablAuditTool(), NablDiscoveryTool()],
+        tools=[_AUDIT_TOOL, _DISCOVERY_TOOL],
+        step_callback=step_callback,
         verbose=True
     )
 
 
 # API Endpoints
-class ChatRequest(BaseModel):
+class ChatRequest(msgspec.Struct):
     message: str
     user_id: str | None = None
 
 
-class ChatResponse(BaseModel):
+class ChatResponse(msgspec.Struct):
     response: str
 
 
-@app.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
-    """Process a chat message through the CrewAI agent."""
-    
-    agent = create_research_agent()
+_chat_request_decoder = msgspec.json.Decoder(ChatRequest)
+
+
+async def decode_body(http_request: Request, decoder: msgspec.json.Decoder):
+    """Decode and validate a JSON request body, mapping failures to a 422."""
+    try:
+        return decoder.decode(await http_request.body())
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+def encode_response(data) -> Response:
+    return Response(content=msgspec.json.encode(data), media_type="application/json")
+
+
+def build_crew(request: ChatRequest, step_callback=None) -> Crew:
+    # The callback goes on the agent itself; Crew only copies its own
+    # step_callback onto agents that don't already have one
+    agent = create_research_agent(step_callback=step_callback)
     
     task = Task(
         description=f"""
@@ -134,16 +257,60 @@ async def chat(request: ChatRequest):
         agent=agent
     )
     
-    crew = Crew(
+    return Crew(
         agents=[agent],
         tasks=[task],
         process=Process.sequential,
         verbose=True
     )
+
+
+def format_sse(event: str, data) -> bytes:
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+
+
+@app.post("/chat")
+async def chat(http_request: Request):
+    """Process a chat message through the CrewAI agent."""
+    request: ChatRequest = await decode_body(http_request, _chat_request_decoder)
+    crew = build_crew(request)
+    
+    loop = asyncio.get_running_loop()
+    result = await loop.run_in_executor(_KICKOFF_EXECUTOR, crew.kickoff)
+    
+    return encode_response(ChatResponse(response=str(result)))
+
+
+@app.post("/chat/stream")
+async def chat_stream(http_request: Request):
+    """Stream the crew's progress as server-sent events.
+    
+    Emits a "step" event for every agent step (thoughts, tool calls) and a
+    final "done" event with the response (or an "error" event on failure).
+    """
+    request: ChatRequest = await decode_body(http_request, _chat_request_decoder)
+    loop = asyncio.get_running_loop()
+    steps: asyncio.Queue = asyncio.Queue()
+    
+    def on_step(step):
+        # Called from the kickoff worker thread
+        loop.call_soon_threadsafe(steps.put_nowait, getattr(step, "text", None) or str(step))
+    
+    crew = build_crew(request, step_callback=on_step)
+    future = loop.run_in_executor(_KICKOFF_EXECUTOR, crew.kickoff)
+    future.add_done_callback(lambda _: steps.put_nowait(None))
     
-    result = crew.kickoff()
+    async def generator():
+        while (text := await steps.get()) is not None:
+            yield format_sse("step", {"text": text})
+        try:
+            result = await future
+        except Exception as e:
+            yield format_sse("error", {"error": str(e)})
+            return
+        yield format_sse("done", {"response": str(result)})
     
-    return ChatResponse(response=str(result))
+    return StreamingResponse(generator(), media_type="text/event-stream")
 
 
 @app.get("/health")
@@ -3,64 +3,172 @@ LangGraph nabl Integration
 FastAPI server that exposes LangGraph agents with nabl workflow tools
 """
 
+import asyncio
+import hashlib
 import os
-import httpx
+import aiohttp
+import msgspec
+import orjson
+import redis.asyncio as redis
+from cachetools import TLRUCache
+from collections import OrderedDict
+from contextlib import AsyncExitStack, asynccontextmanager
 from typing import TypedDict, Annotated, Literal
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from weakref import WeakValueDictionary
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from urllib.parse import urlsplit, urlunsplit
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.checkpoint.redis.aio import AsyncRedisSaver
 from langgraph.graph import StateGraph, END
+from langgraph.graph.message import add_messages
 from langchain_anthropic import ChatAnthropic
-from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
+from langchain_core.messages import HumanMessage, AIMessage, SystemMessage, ToolMessage, RemoveMessage
+from langchain_core.messages.utils import count_tokens_approximately, trim_messages
 from langchain_core.tools import tool
 
 # Configuration
 ICLAW_API_URL = os.getenv("ICLAW_API_URL", "https://api.iclaw.dev")
 ICLAW_API_KEY = os.getenv("ICLAW_API_KEY")
 ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
+REDIS_URL = os.getenv("REDIS_URL")
+# A slow Redis should count as a cache miss, not stall the tool call
+REDIS_TIMEOUT = float(os.getenv("REDIS_TIMEOUT", "0.5"))
+# Needs Redis Stack (RedisJSON + RediSearch); conversations stay in memory if unset
+CHECKPOINT_REDIS_URL = os.getenv("CHECKPOINT_REDIS_URL")
+# Most conversations the in-memory checkpointer keeps before evicting the LRU one
+CHECKPOINT_MAX_THREADS = int(os.getenv("CHECKPOINT_MAX_THREADS", "1000"))
+# Approximate token budget for the conversation history sent to the LLM
+HISTORY_MAX_TOKENS = int(os.getenv("HISTORY_MAX_TOKENS", "16000"))
+
+JSON_HEADERS = {"content-type": "application/json"}
+
+# Fail fast on an unreachable upstream: tight connect (incl. waiting for a
+# pooled connection) limits. The read limit must exceed the slowest workflow:
+# discovery sends nothing until its Apify poll ends (up to 120s), and giving
+# up early still gets the run charged to the wallet.
+WORKFLOW_TIMEOUT = aiohttp.ClientTimeout(total=None, connect=10, sock_connect=5, sock_read=150)
+WORKFLOW_CONNECT_RETRIES = 2
+WORKFLOW_RETRY_BACKOFF = 0.5
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Share one HTTP session (and its connection pool) across all tool calls.
+    
+    When REDIS_URL is set, a Redis client is shared too so tool results are
+    cached across workers and replicas. The agent graph is compiled here with
+    a checkpointer so conversations resume per user_id; anonymous requests use
+    a second graph compiled without one, so they leave nothing behind.
+    """
+    app.state.http = aiohttp.ClientSession(
+        timeout=WORKFLOW_TIMEOUT,
+        connector=aiohttp.TCPConnector(
+            limit=1000,
+            limit_per_host=200,
+            keepalive_timeout=30,
+            resolver=aiohttp.AsyncResolver(),
+            ttl_dns_cache=60
+        )
+    )
+    # Open a keep-alive connection up front so the first tool call skips the
+    # DNS lookup and TLS handshake
+    try:
+        async with app.state.http.get(
+            f"{ICLAW_API_URL}/health",
+            timeout=aiohttp.ClientTimeout(total=5)
+        ) as response:
+            await response.read()
+    except Exception:
+        pass
+    app.state.redis = redis.Redis.from_url(
+        REDIS_URL,
+        socket_timeout=REDIS_TIMEOUT,
+        socket_connect_timeout=REDIS_TIMEOUT
+    ) if REDIS_URL else None
+    async with AsyncExitStack() as stack:
+        if CHECKPOINT_REDIS_URL:
+            checkpointer = await stack.enter_async_context(
+                AsyncRedisSaver.from_conn_string(CHECKPOINT_REDIS_URL)
+            )
+            await checkpointer.asetup()
+        else:
+            checkpointer = BoundedMemorySaver(CHECKPOINT_MAX_THREADS)
+        app.state.agent = build_agent_graph(checkpointer)
+        app.state.stateless_agent = build_agent_graph(None)
+        yield
+    await app.state.http.close()
+    if app.state.redis is not None:
+        await app.state.redis.aclose()
+
 
-app = FastAPI(title="iClaw LangGraph Agent")
+app = FastAPI(
+    title="iClaw LangGraph Agent",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
+)
 
 # Tools
 
+async def _post_workflow(workflow: str, params: dict) -> dict:
+    """POST a workflow run, retrying only when the connection could not be made.
+    
+    SSL and certificate failures are not transient, so they are raised
+    immediately; other connect errors back off exponentially between tries.
+    """
+    payload = orjson.dumps({
+        "workflow": workflow,
+        "params": params,
+        "iclaw_key": ICLAW_API_KEY
+    })
+    for attempt in range(WORKFLOW_CONNECT_RETRIES + 1):
+        try:
+            async with app.state.http.post(
+                f"{ICLAW_API_URL}/api/v1/workflow",
+                data=payload,
+                headers=JSON_HEADERS
+            ) as response:
+                return orjson.loads(await response.read())
+        except aiohttp.ClientSSLError:
+            raise
+        except aiohttp.ClientConnectorError:
+            if attempt == WORKFLOW_CONNECT_RETRIES:
+                raise
+            await asyncio.sleep(WORKFLOW_RETRY_BACKOFF * 2 ** attempt)
+
+
 @tool
 async def nabl_audit(url: str) -> dict:
     """Run a comprehensive website audit. Use this when asked to check, audit, or analyze a website."""
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            f"{ICLAW_API_URL}/api/v1/workflow",
-            json={
-                "workflow": "audit",
-                "params": {"url": url},
-                "iclaw_key": ICLAW_API_KEY
-            },
-            timeout=120.0
-        )
-        return response.json()
+    return await _post_workflow("audit", {"url": url})
 
 
 @tool
 async def nabl_discovery(niche: str, location: str, limit: int = 50) -> dict:
     """Find businesses by niche and location. Use this when asked to find, discover, or search for businesses."""
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            f"{ICLAW_API_URL}/api/v1/workflow",
-            json={
-                "workflow": "discovery",
-                "params": {"niche": niche, "location": location, "limit": limit},
-                "iclaw_key": ICLAW_API_KEY
-            },
-            timeout=120.0
-        )
-        return response.json()
+    return await _post_workflow("discovery", {"niche": niche, "location": location, "limit": limit})
 
 
 # Agent State
 class AgentState(TypedDict):
-    messages: list
+    messages: Annotated[list, add_messages]
     tool_calls: list
     tool_results: list
 
 
+SYSTEM_PROMPT = """You are iClaw, an AI assistant that can help with:
+- Website audits (use nabl_audit tool)
+- Finding businesses (use nabl_discovery tool)
+
+Be concise and helpful. When using tools, explain what you're doing."""
+
+# Tool specs are sent ahead of the system prompt, so this cache breakpoint
+# covers both of them
+SYSTEM_MSG = SystemMessage(content=[
+    {"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}
+])
+
+
 # LLM
 llm = ChatAnthropic(
     model="claude-sonnet-4-20250514",
@@ -69,38 +177,191 @@ llm = ChatAnthropic(
 
 
 # Graph nodes
+def _prepare_history(messages: list) -> tuple[list, list]:
+    """Split a thread into the history to send and the messages to drop.
+    
+    Drops tool calls that never got results (a run cancelled between the
+    agent and tool nodes, e.g. a /chat/stream client disconnecting), which
+    Anthropic would reject on every later turn. Then keeps the most recent
+    HISTORY_MAX_TOKENS worth of whole turns, starting on a HumanMessage; the
+    current turn is always kept even if it is over budget.
+    """
+    answered = {m.tool_call_id for m in messages if isinstance(m, ToolMessage)}
+    dangling = set()
+    for m in messages:
+        if isinstance(m, AIMessage) and any(tool_call["id"] not in answered for tool_call in m.tool_calls):
+            dangling.update(tool_call["id"] for tool_call in m.tool_calls)
+    
+    def is_dangling(m) -> bool:
+        if isinstance(m, AIMessage):
+            return any(tool_call["id"] in dangling for tool_call in m.tool_calls)
+        return isinstance(m, ToolMessage) and m.tool_call_id in dangling
+    
+    history = trim_messages(
+        [m for m in messages if not is_dangling(m)],
+        max_tokens=HISTORY_MAX_TOKENS,
+        token_counter=count_tokens_approximately,
+        strategy="last",
+        start_on="human"
+    )
+    if not history:
+        last_human = max(i for i, m in enumerate(messages) if isinstance(m, HumanMessage))
+        history = [m for m in messages[last_human:] if not is_dangling(m)]
+    
+    kept = {m.id for m in history}
+    return history, [m for m in messages if m.id not in kept]
+
+
 async def agent_node(state: AgentState) -> AgentState:
     """Main agent node that processes messages."""
-    messages = state["messages"]
+    history, stale = _prepare_history(state["messages"])
     
-    response = await llm.ainvoke(messages)
+    # The system prompt is not checkpointed, so it is prepended on every call
+    response = await llm.ainvoke([SYSTEM_MSG, *history])
     
+    # Trimmed messages are removed from the thread too, so it stays bounded
     return {
-        **state,
-        "messages": messages + [response],
+        "messages": [*(RemoveMessage(id=m.id) for m in stale), response],
         "tool_calls": response.tool_calls if hasattr(response, 'tool_calls') else []
     }
 
 
+# Tool result cache, keyed on tool name + canonicalized args. An in-process
+# TLRUCache (LRU beyond 4096 entries) sits in front of Redis (when configured),
+# which is shared by all workers. Local entries written here live for
+# TOOL_CACHE_TTL; entries copied from a Redis hit expire with the Redis key.
+TOOL_CACHE_TTL = 3600
+
+
+def _tool_cache_ttu(key, value, now):
+    # Entries are (result, ttl) so hits copied from Redis expire with the
+    # Redis key instead of getting a fresh TOOL_CACHE_TTL
+    return now + value[1]
+
+
+_tool_cache: TLRUCache = TLRUCache(maxsize=4096, ttu=_tool_cache_ttu)
+_tool_cache_lock = asyncio.Lock()
+
+
+def _canonical_url(url: str) -> str:
+    """Lowercase only the scheme and host; paths and queries are case-sensitive."""
+    url = url.strip()
+    if "://" not in url and not url.startswith("//"):
+        url = "//" + url
+    parts = urlsplit(url)
+    return urlunsplit(parts._replace(scheme=parts.scheme.lower(), netloc=parts.netloc.lower()))
+
+
+def _cache_key(tool_call: dict) -> tuple | None:
+    args = tool_call["args"]
+    if tool_call["name"] == "nabl_audit":
+        return ("nabl_audit", _canonical_url(str(args.get("url", ""))))
+    if tool_call["name"] == "nabl_discovery":
+        return (
+            "nabl_discovery",
+            str(args.get("niche", "")).strip().lower(),
+            str(args.get("location", "")).strip().lower(),
+            int(args.get("limit", 50))
+        )
+    return None
+
+
+def _redis_key(key: tuple) -> str:
+    name, *args = key
+    digest = hashlib.sha256(orjson.dumps(args)).hexdigest()
+    return f"iclaw:{name.removeprefix('nabl_')}:{digest}"
+
+
+async def _cache_get(key: tuple) -> dict | None:
+    async with _tool_cache_lock:
+        entry = _tool_cache.get(key)
+    if entry is not None:
+        return entry[0]
+    if app.state.redis is None:
+        return None
+    
+    try:
+        async with app.state.redis.pipeline(transaction=False) as pipe:
+            pipe.get(_redis_key(key))
+            pipe.pttl(_redis_key(key))
+            raw, pttl = await pipe.execute()
+    except redis.RedisError:
+        return None
+    if raw is None:
+        return None
+    
+    cached = orjson.loads(raw)
+    if pttl > 0:
+        async with _tool_cache_lock:
+            _tool_cache[key] = (cached, pttl / 1000)
+    return cached
+
+
+async def _cache_put(key: tuple, result: dict) -> None:
+    # Guarded here as well, since a bad entry in Redis reaches every replica
+    # and survives restarts
+    if result.get("status") != "success":
+        return
+    async with _tool_cache_lock:
+        _tool_cache[key] = (result, TOOL_CACHE_TTL)
+    if app.state.redis is None:
+        return
+    
+    try:
+        await app.state.redis.set(_redis_key(key), orjson.dumps(result), ex=TOOL_CACHE_TTL)
+    except redis.RedisError:
+        pass
+
+
+async def _invoke_tool(tool_call: dict) -> tuple[dict, str]:
+    """Run a tool call, returning its result and cache status (HIT/MISS)."""
+    key = _cache_key(tool_call)
+    if key is None:
+        return {"error": f"Unknown tool: {tool_call['name']}"}, "MISS"
+    
+    cached = await _cache_get(key)
+    if cached is not None:
+        return cached, "HIT"
+    
+    if tool_call["name"] == "nabl_audit":
+        result = await nabl_audit.ainvoke(tool_call["args"])
+    else:
+        result = await nabl_discovery.ainvoke(tool_call["args"])
+    
+    # Only successes: 'pending' and 'insufficient_balance' must not outlive
+    # the job finishing or the wallet being topped up
+    if result.get("status") == "success":
+        await _cache_put(key, result)
+    return result, "MISS"
+
+
 async def tool_node(state: AgentState) -> AgentState:
-    """Execute tool calls."""
-    tool_results = []
+    """Execute tool calls concurrently."""
+    tool_calls = state.get("tool_calls", [])
+    results = await asyncio.gather(
+        *(_invoke_tool(tool_call) for tool_call in tool_calls),
+        return_exceptions=True
+    )
     
-    for tool_call in state.get("tool_calls", []):
-        if tool_call["name"] == "nabl_audit":
-            result = await nabl_audit.ainvoke(tool_call["args"])
-        elif tool_call["name"] == "nabl_discovery":
-            result = await nabl_discovery.ainvoke(tool_call["args"])
+    tool_messages = []
+    tool_results = []
+    for tool_call, outcome in zip(tool_calls, results):
+        if isinstance(outcome, Exception):
+            result, cache_status = {"error": str(outcome)}, "MISS"
         else:
-            result = {"error": f"Unknown tool: {tool_call['name']}"}
-        
+            result, cache_status = outcome
+        tool_messages.append(ToolMessage(
+            content=orjson.dumps(result).decode(),
+            tool_call_id=tool_call["id"]
+        ))
         tool_results.append({
             "tool_call_id": tool_call["id"],
-            "result": result
+            "result": result,
+            "cache": cache_status
         })
     
     return {
-        **state,
+        "messages": tool_messages,
         "tool_results": tool_results
     }
 
@@ -113,7 +374,26 @@ def should_continue(state: AgentState) -> Literal["tool", "end"]:
 
 
 # Build graph
-def build_agent_graph():
+class BoundedMemorySaver(MemorySaver):
+    """MemorySaver that only keeps the max_threads most recently written threads."""
+    
+    def __init__(self, max_threads: int):
+        super().__init__()
+        self.max_threads = max_threads
+        self._recent_threads: OrderedDict[str, None] = OrderedDict()
+    
+    def put(self, config, checkpoint, metadata, new_versions):
+        # aput() delegates here, so this covers async runs too
+        thread_id = config["configurable"]["thread_id"]
+        self._recent_threads[thread_id] = None
+        self._recent_threads.move_to_end(thread_id)
+        while len(self._recent_threads) > self.max_threads:
+            evicted, _ = self._recent_threads.popitem(last=False)
+            self.delete_thread(evicted)
+        return super().put(config, checkpoint, metadata, new_versions)
+
+
+def build_agent_graph(checkpointer):
     graph = StateGraph(AgentState)
     
     graph.add_node("agent", agent_node)
@@ -123,44 +403,87 @@ def build_agent_graph():
     graph.add_conditional_edges("agent", should_continue, {"tool": "tool", "end": END})
     graph.add_edge("tool", "agent")
     
-    return graph.compile()
+    return graph.compile(checkpointer=checkpointer)
 
 
-agent = build_agent_graph()
+# API Endpoints
+RESPONSE_NOT_FOUND = "I couldn't process that request."
 
+# One lock per live thread_id so concurrent runs can't interleave a history.
+# Entries disappear once no request holds the lock. This only serializes
+# within one process; replicas sharing a Redis checkpointer are not covered.
+_thread_locks: WeakValueDictionary[str, asyncio.Lock] = WeakValueDictionary()
 
-# API Endpoints
-class ChatRequest(BaseModel):
+# Caps concurrent agent runs from /chat/batch to stay within Anthropic rate limits
+_batch_semaphore = asyncio.Semaphore(int(os.getenv("BATCH_CONCURRENCY", "32")))
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "100"))
+
+
+class ChatRequest(msgspec.Struct):
     message: str
     user_id: str | None = None
 
 
-class ChatResponse(BaseModel):
+class ChatResponse(msgspec.Struct):
     response: str
     tool_results: list = []
 
 
-@app.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
-    """Process a chat message through the agent."""
-    initial_state: AgentState = {
-        "messages": [
-            SystemMessage(content="""You are iClaw, an AI assistant that can help with:
-- Website audits (use nabl_audit tool)
-- Finding businesses (use nabl_discovery tool)
+class ChatError(msgspec.Struct):
+    error: str
+
+
+_chat_request_decoder = msgspec.json.Decoder(ChatRequest)
+_chat_batch_decoder = msgspec.json.Decoder(
+    Annotated[list[ChatRequest], msgspec.Meta(max_length=BATCH_MAX_SIZE)]
+)
+
+
+async def decode_body(http_request: Request, decoder: msgspec.json.Decoder):
+    """Decode and validate a JSON request body, mapping failures to a 422."""
+    try:
+        return decoder.decode(await http_request.body())
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
 
-Be concise and helpful. When using tools, explain what you're doing."""),
-            HumanMessage(content=request.message)
-        ],
+
+def encode_response(data) -> Response:
+    return Response(content=msgspec.json.encode(data), media_type="application/json")
+
+
+def build_initial_state(request: ChatRequest) -> AgentState:
+    # Prior messages are restored from the checkpointer; only this turn is sent
+    return {
+        "messages": [HumanMessage(content=request.message)],
         "tool_calls": [],
         "tool_results": []
     }
+
+
+@asynccontextmanager
+async def agent_session(request: ChatRequest):
+    """Yield the graph and run config for a request.
     
-    result = await agent.ainvoke(initial_state)
+    Requests with a user_id resume that user's thread, one run at a time;
+    anonymous ones run on the stateless graph so nothing is checkpointed.
+    """
+    if not request.user_id:
+        yield app.state.stateless_agent, {}
+        return
     
+    lock = _thread_locks.get(request.user_id)
+    if lock is None:
+        lock = _thread_locks[request.user_id] = asyncio.Lock()
+    async with lock:
+        yield app.state.agent, {"configurable": {"thread_id": request.user_id}}
+
+
+def build_chat_response(result: AgentState) -> ChatResponse:
     # Get the last AI message
-    ai_messages = [m for m in result["messages"] if isinstance(m, AIMessage)]
-    response_text = ai_messages[-1].content if ai_messages else "I couldn't process that request."
+    response_text = next(
+        (m.content for m in reversed(result["messages"]) if isinstance(m, AIMessage)),
+        RESPONSE_NOT_FOUND
+    )
     
     return ChatResponse(
         response=response_text,
@@ -168,6 +491,84 @@ Be concise and helpful. When using tools, explain what you're doing."""),
     )
 
 
+def format_sse(event: str, data) -> bytes:
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+
+
+def _chunk_text(chunk) -> str:
+    """Extract the text from a streamed chunk, skipping tool_use deltas."""
+    if isinstance(chunk.content, str):
+        return chunk.content
+    return "".join(
+        block.get("text", "")
+        for block in chunk.content
+        if isinstance(block, dict) and block.get("type") == "text"
+    )
+
+
+@app.post("/chat")
+async def chat(http_request: Request):
+    """Process a chat message through the agent."""
+    request: ChatRequest = await decode_body(http_request, _chat_request_decoder)
+    async with agent_session(request) as (graph, config):
+        result = await graph.ainvoke(build_initial_state(request), config)
+    return encode_response(build_chat_response(result))
+
+
+@app.post("/chat/batch")
+async def chat_batch(http_request: Request):
+    """Process several chat messages concurrently, sharing the graph and HTTP pool.
+    
+    Results come back in request order; an item that fails (e.g. an Anthropic
+    429) yields {"error": ...} without affecting the rest of the batch.
+    Batches larger than BATCH_MAX_SIZE are rejected with a 422.
+    """
+    requests: list[ChatRequest] = await decode_body(http_request, _chat_batch_decoder)
+    
+    async def run(request: ChatRequest) -> ChatResponse | ChatError:
+        try:
+            # Take the thread lock first so queued same-user items hold no slot
+            async with agent_session(request) as (graph, config), _batch_semaphore:
+                result = await graph.ainvoke(build_initial_state(request), config)
+        except Exception as e:
+            return ChatError(error=str(e))
+        return build_chat_response(result)
+    
+    return encode_response(await asyncio.gather(*(run(request) for request in requests)))
+
+
+@app.post("/chat/stream")
+async def chat_stream(http_request: Request):
+    """Stream the agent's reply as server-sent events.
+    
+    Emits a "token" event per text delta from the LLM and a final "done"
+    event carrying the tool_results (or an "error" event on failure).
+    """
+    request: ChatRequest = await decode_body(http_request, _chat_request_decoder)
+    
+    async def generator():
+        tool_results = []
+        try:
+            async with agent_session(request) as (graph, config):
+                async for event in graph.astream_events(
+                    build_initial_state(request),
+                    config,
+                    version="v2"
+                ):
+                    if event["event"] == "on_chat_model_stream":
+                        text = _chunk_text(event["data"]["chunk"])
+                        if text:
+                            yield format_sse("token", {"text": text})
+                    elif event["event"] == "on_chain_end" and event["name"] == "tool":
+                        tool_results = event["data"]["output"].get("tool_results", [])
+        except Exception as e:
+            yield format_sse("error", {"error": str(e)})
+            return
+        yield format_sse("done", {"tool_results": tool_results})
+    
+    return StreamingResponse(generator(), media_type="text/event-stream")
+
+
 @app.get("/health")
 async def health():
     return {"status": "healthy", "framework": "langgraph"}